@@ -1,6 +1,6 @@
 from concurrent import futures
 
-import psycopg2, requests, json, time, io
+import aiohttp, asyncio, collections, psycopg, psycopg_pool, json, orjson, time, queue, threading
 
 with open('config.json', 'r') as configFile:
     config = json.load(configFile)
@@ -9,6 +9,57 @@ api_config = config['API']
 db_config = config['Database']
 sql_config = config['SQL']
 
+# Bungie throttles above 25 requests per second, so no more than that many
+# requests are started in any one second
+max_requests_per_second = 25
+
+# Requests in flight at once, and keep-alive connections shared by all of them
+max_requests = 25
+
+# Sent with every request by the shared ClientSession
+headers = {'X-API-Key': api_config['xApiKey']}
+
+
+def split_url(url):
+    # Splits the {0}/{1}/{2} request URL template into its fixed parts
+    prefix, rest = url.split('{0}')
+    account, rest = rest.split('{1}')
+    character, suffix = rest.split('{2}')
+
+    return prefix, account, character, suffix
+
+
+url_prefix, url_account, url_character, url_suffix = split_url(api_config['url'])
+
+# Failed requests tolerated before the load is abandoned: a full round of
+# requests, or one in a hundred of the requests made so far if that is more
+max_failed_requests = 25
+max_failed_ratio = 0.01
+
+# Bungie ErrorCode for the API being down for maintenance
+system_disabled = 5
+
+# Characters whose rows may wait in memory for the COPY to catch up
+max_queued = 100
+
+# Concurrent COPY streams into the activity table, each on its own connection
+copy_writers = 4
+
+# Bytes of rows collected before each write to the COPY
+copy_block_size = 64 * 1024
+
+# Session settings for every connection of the bulk load. The table is truncated
+# and reloaded from Bungie, so losing the last commits on a crash only means
+# running the load again; the extra memory speeds up index builds and the refresh
+session_options = '-c synchronous_commit=off -c maintenance_work_mem=512MB'
+
+# Shared by the pool and the async connection that streams the characters
+connection_kwargs = {'host': db_config['host'], 'port': db_config['port'], 'dbname': db_config['database'], 'user': db_config['user'], 'password': db_config['password'], 'options': session_options}
+
+# Connections are kept open between invocations of a warm Lambda and shared
+# by the loader, index and analyze threads
+pool = psycopg_pool.ConnectionPool(min_size=2, max_size=8, open=True, kwargs=connection_kwargs)
+
 
 def execute_ddl(db, ddl):
     print('Executing DDL statement on database...')
@@ -24,194 +75,351 @@ def execute_ddl(db, ddl):
     print('Database Execution: {0:.2f}s'.format(ddl_duration))
 
 
-def get_characters(db):
-    print('Getting characters...')
+def execute_ddl_batch(db, ddls):
+    print('Executing {0} DDL statements on database...'.format(len(ddls)))
 
-    character_sql = sql_config['characterSelect']
+    start = time.time()
 
-    pg_cursor = db.cursor()
-    pg_cursor.execute(character_sql)
+    # Pipeline mode sends all of the statements in one round trip
+    with db.pipeline():
+        pg_cursor = db.cursor()
 
-    characters = pg_cursor.fetchall()
+        for ddl in ddls:
+            pg_cursor.execute(ddl)
 
-    characters = list(map(list, characters))
+    db.commit()
 
-    return characters
+    end = time.time()
+    ddl_duration = end - start
+    print('Database Execution: {0:.2f}s'.format(ddl_duration))
 
 
-def build_requests(characters):
-    print('Building requests...')
+def execute_ddl_connected(ddl):
+    # Runs on its own connection so it can overlap with work on other connections
+    with pool.connection() as db:
+        execute_ddl(db, ddl)
 
-    requests = []
 
-    for character in characters:
-        #print(character[0])
-        url = [api_config['url'].format(character[0]['destiny_membership_type'], character[0]['destiny_id'], character[0]['character_id'])]
+def create_indexes(ddls):
+    print('Creating indexes...')
 
-        character[0]['requestUrl'] = url
-        #print(json.dumps(character))
+    start = time.time()
 
-        requests.append(character)
+    with futures.ThreadPoolExecutor(len(ddls)) as executor:
+        builds = [executor.submit(execute_ddl_connected, ddl) for ddl in ddls]
 
-    return requests
+    for build in futures.as_completed(builds):
+        build.result()
 
+    end = time.time()
+    index_duration = end - start
+    print('Index Execution: {0:.2f}s'.format(index_duration))
 
-def process_requests(characters):
-    print('Processing requests...')
 
-    stats = []
+async def get_characters(db):
+    print('Getting characters...')
 
-    character_count = len(characters)
-    print('Requests {0}'.format(character_count))
-    chunk_size = 25
-    start = 0
+    character_sql = sql_config['characterSelect']
 
-    api_start_time = time.time()
+    # Server-side cursor so the characters are streamed instead of fetched at once,
+    # on an async connection so each FETCH does not hold up the requests in flight
+    pg_cursor = db.cursor(name='characters')
+    pg_cursor.itersize = 2000
+    await pg_cursor.execute(character_sql)
 
-    for start in range(0, character_count, chunk_size):
-        end = start + chunk_size - 1
-        if end > character_count:
-            end = character_count - 1
+    return pg_cursor
 
-        #print('({0},{1})'.format(start, end))
 
-        print('Processing chunk {0} - {1}'.format(str(start), str(end)))
-        chunk = end - start + 1
+async def build_requests(characters):
+    print('Building requests...')
+
+    async for character in characters:
+        #print(character[0])
+        character[0]['requestUrl'] = f"{url_prefix}{character[0]['destiny_membership_type']}{url_account}{character[0]['destiny_id']}{url_character}{character[0]['character_id']}{url_suffix}"
+        #print(json.dumps(character))
+
+        yield character
+
 
-        with futures.ThreadPoolExecutor(chunk) as executor:
-            future_to_url = {executor.submit(get_stats, character): character for character in characters[start:(end + 1)]}
+async def queue_requests(characters, pending):
+    async for character in characters:
+        await pending.put(character)
 
-        for response in futures.as_completed(future_to_url):
-            stats.append(response.result())
+    # One end marker for each worker
+    for _ in range(max_requests):
+        await pending.put(None)
+
+
+def process_requests(queues):
+    print('Processing requests...')
+
+    api_start_time = time.time()
+
+    try:
+        tally = asyncio.run(fetch_stats(queues))
+    except Exception as error:
+        # Hand the failure to the loaders so the COPY is aborted, not committed
+        for rows in queues:
+            rows.put(error)
+        raise
+    else:
+        for rows in queues:
+            rows.put(None)
+
+    print('Requests {0}, failed {1}'.format(tally['requests'], tally['failed']))
 
     api_end_time = time.time()
     api_duration = api_end_time - api_start_time
 
     print('API Execution: {0:.2f}s'.format(api_duration))
-    return stats
 
 
-def get_stats(character):
+def check_failures(tally):
+    # A few dropped requests are tolerated, but an outage fails most of them and
+    # loading without those characters would empty the view on refresh
+    if tally['failed'] > max(max_failed_requests, max_failed_ratio * tally['requests']):
+        raise RuntimeError('{0} of {1} requests failed'.format(tally['failed'], tally['requests']))
+
+
+class RequestLimiter:
+    # Remembers the last rate request starts and holds the next one back until
+    # the oldest of them is a full second old
+    def __init__(self, rate):
+        self.starts = collections.deque(maxlen=rate)
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+
+        while len(self.starts) == self.starts.maxlen:
+            delay = self.starts[0] + 1 - loop.time()
+
+            if delay <= 0:
+                break
+
+            await asyncio.sleep(delay)
+
+        self.starts.append(loop.time())
+
+
+async def fetch_stats(queues):
+    limiter = RequestLimiter(max_requests_per_second)
+    connector = aiohttp.TCPConnector(limit=max_requests, ttl_dns_cache=300)
+    pending = asyncio.Queue(maxsize=max_requests)
+    tally = collections.Counter(requests=0, failed=0)
+
+    async with await psycopg.AsyncConnection.connect(**connection_kwargs) as db, aiohttp.ClientSession(connector=connector, headers=headers) as session:
+        # Retrieve characters and build requests
+        characters = build_requests(await get_characters(db))
+
+        # Each worker pulls the next character itself, so only max_requests are in flight.
+        # If one task fails the task group cancels the others before the session closes
+        async with asyncio.TaskGroup() as group:
+            group.create_task(queue_requests(characters, pending))
+            for _ in range(max_requests):
+                group.create_task(fetch_worker(session, limiter, pending, queues, tally))
+
+    return tally
+
+
+async def fetch_worker(session, limiter, pending, queues, tally):
+    while True:
+        character = await pending.get()
+
+        if character is None:
+            break
+
+        tally['requests'] += 1
+
+        if not await get_stats(session, limiter, character, queues):
+            tally['failed'] += 1
+
+            # Abandon the load as soon as the failures point to an outage
+            check_failures(tally)
+
+
+async def get_stats(session, limiter, character, queues):
     # print('Getting stats...')
 
-    x_api_key = api_config['xApiKey']
-    #print(character[0]['requestUrl'][0])
+    #print(character[0]['requestUrl'])
 
-    response = requests.get(character[0]['requestUrl'][0], headers={'X-API-Key': x_api_key})
-    stats = response.text
-    #print(stats)
-    character[0]['stats'] = json.loads(stats)
+    await limiter.wait()
 
-    #print(json.dumps(character))
+    try:
+        async with session.get(character[0]['requestUrl']) as response:
+            body = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        print('Failed {0}: {1!r}'.format(character[0]['requestUrl'], error))
+        return False
 
-    # print(json.loads(stats)['ErrorStatus'])
+    try:
+        stats = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        stats = {}
 
-    return character
+    error_code = stats.get('ErrorCode')
+    error_status = stats.get('ErrorStatus') or ''
 
+    # No Bungie error body, maintenance or throttling would fail any character
+    if error_code is None or error_code == system_disabled or 'Throttle' in error_status:
+        print('Failed {0}: HTTP {1}, ErrorCode {2}, ErrorStatus {3}'.format(character[0]['requestUrl'], response.status, error_code, error_status))
+        return False
 
-def build_inserts(character_stats):
-    print('Building database inserts...')
+    # Private profiles and deleted characters only concern this character
+    if error_code != 1:
+        print('Skipping {0}: HTTP {1}, ErrorCode {2}, ErrorStatus {3}'.format(character[0]['requestUrl'], response.status, error_code, error_status))
+        return True
 
-    inserts = []
+    activities = stats.get('Response', {}).get('activities')
 
-    for character in character_stats:
-        activities = character[0]['stats']['Response']['activities']
+    # Nothing to load for characters without activity
+    if not activities:
+        return True
 
-        for activity in activities:
-            activityHash = [activity['activityHash']]
+    # The rows are generated lazily by the loader thread as it writes the COPY
+    inserts = build_inserts(character, activities)
 
-            stats = activity['values']
-            for stat in stats:
-                data = stats[stat]
-                #print(character[0])
-                insert = [character[0]['group_id'], character[0]['clan_id'], character[0]['member_id'], character[0]['character_id']] + activityHash + [stat] + [json.dumps(data)]
-                #print(insert)
-                inserts.append(insert)
-    return inserts
+    # Each character always goes to the same COPY writer
+    rows = queues[character[0]['character_id'] % len(queues)]
 
+    # A full queue means the COPY is behind, so wait off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, rows.put, inserts)
 
-def load_data(db, data):
+    return True
 
-    insert_count = len(data)
-    print(insert_count)
-    chunk_size = 10000
 
-    if chunk_size > insert_count:
-        chunk_size = insert_count
+def build_inserts(character, activities):
+    # Hoist the per-character values out of the stat loop
+    group_id, clan_id, member_id, character_id = character[0]['group_id'], character[0]['clan_id'], character[0]['member_id'], character[0]['character_id']
+    dumps = orjson.dumps
 
-    start = 0
-    total_inserts = 0
+    for activity in activities:
+        activity_hash = activity['activityHash']
 
-    db_start_time = time.time()
+        for stat, data in activity['values'].items():
+            yield (group_id, clan_id, member_id, character_id, activity_hash, stat, dumps(data))
 
-    print(insert_count)
 
-    for start in range(0, insert_count, chunk_size):
-        end = start + chunk_size - 1
-        if end > insert_count:
-            end = insert_count - 1
+def read_rows(rows, finished):
+    # Yields the rows queued by get_stats until process_requests signals the end
+    while True:
+        inserts = rows.get()
 
-        #if (i % chunkSize == 0 and i > 0) or i == (insert_count - 1):
-        print('Processing chunk {0} - {1}'.format(str(start), str(end)))
+        if inserts is None or isinstance(inserts, Exception):
+            finished.set()
 
-        chunk = data[start:(end+1)]
+            if inserts is None:
+                return
 
-        file_data = ''
+            raise inserts
 
-        for row in chunk:
-            #print(row)
-            file_data += '\t'.join(str(value) for value in row) + '\n'
-            #print(file_data)
-            total_inserts += 1
+        yield from inserts
 
-        buffer = io.StringIO()
-        buffer.write(file_data)
-        buffer.seek(0)
 
-        pg_cursor = db.cursor()
-        pg_cursor.copy_from(buffer, 'stats.t_aggregate_activity_stats', sep='\t', columns=('group_id', 'clan_id', 'member_id', 'character_id', 'activity_hash', 'stat_id', 'stat'))
+def copy_value(value):
+    # Integers go out bare; everything else is a quoted CSV field, which also
+    # covers tabs, newlines and quotes inside the JSON stat payload
+    if isinstance(value, int):
+        return b'%d' % value
 
-        db.commit()
+    if isinstance(value, str):
+        value = value.encode()
 
-            #start = i + 1
+    return b'"' + value.replace(b'"', b'""') + b'"'
 
-    db_end_time = time.time()
-    db_duration = db_end_time - db_start_time
-    print('Database Loading Execution: {0:.2f}s'.format(db_duration))
 
-    return total_inserts
+def load_data(db, data):
+    print('Loading data...')
 
+    db_start_time = time.time()
 
-def handler(event, context):
-    # Open database connection
-    #pg = pg8000.connect(host=dbConfig['host'], port=dbConfig['port'], database=dbConfig['database'], user=dbConfig['user'], password=dbConfig['password'])
-    pg = psycopg2.connect(host=db_config['host'], port=db_config['port'], database=db_config['database'], user=db_config['user'], password=db_config['password'])
+    count = 0
+    block = bytearray()
+
+    pg_cursor = db.cursor()
+
+    # Rows are collected into blocks so each write to libpq carries many of them
+    with pg_cursor.copy(sql_config['activityCopy']) as copy:
+        for row in data:
+            block += b'\t'.join([copy_value(value) for value in row])
+            block += b'\n'
+            count += 1
 
-    # Truncate table
-    execute_ddl(pg, sql_config['truncateActivity'])
+            if len(block) >= copy_block_size:
+                copy.write(block)
+                block.clear()
 
-    # Retrieve characters
-    characters = get_characters(pg)
+        if block:
+            copy.write(block)
 
-    # Build requests
-    characters = build_requests(characters)
+    db.commit()
 
-    # Process requests
-    character_stats = process_requests(characters)
+    db_end_time = time.time()
+    db_duration = db_end_time - db_start_time
+    print('Database Loading Execution: {0:.2f}s'.format(db_duration))
 
-    # Build inserts
-    inserts = build_inserts(character_stats)
+    return count
 
-    # Load data
-    counts = load_data(pg, inserts)
-    print('Inserts: {0}'.format(counts))
 
-    # Post load activities
-    # Analyze base table after loading
-    execute_ddl(pg, sql_config['analyzeActivityTable'])
-    # Refresh materialized view
-    execute_ddl(pg, sql_config['refreshActivity'])
-    # Analyze materialized view after refresh
-    execute_ddl(pg, sql_config['analyzeActivityView'])
+def load_rows(rows):
+    finished = threading.Event()
 
-    pg.close()
+    try:
+        with pool.connection() as db:
+            try:
+                return load_data(db, read_rows(rows, finished))
+            except Exception:
+                db.rollback()
+                raise
+    finally:
+        # Keep draining so get_stats is never left blocked on a full queue, even
+        # when no connection could be borrowed
+        while not finished.is_set():
+            inserts = rows.get()
+
+            if inserts is None or isinstance(inserts, Exception):
+                break
+
+
+def handler(event, context):
+    # Borrow database connection from the pool
+    #pg = pg8000.connect(host=dbConfig['host'], port=dbConfig['port'], database=dbConfig['database'], user=dbConfig['user'], password=dbConfig['password'])
+    with pool.connection() as pg:
+        # Truncate table, skipping WAL and index maintenance while loading
+        execute_ddl_batch(pg, [
+            sql_config['truncateActivity'],
+            sql_config['unlogActivityTable'],
+            sql_config['dropActivityIndexes']
+        ])
+
+        try:
+            # Process requests and load data as the responses arrive, through
+            # parallel COPY writers each on their own connection
+            queues = [queue.Queue(maxsize=max_queued // copy_writers) for _ in range(copy_writers)]
+
+            with futures.ThreadPoolExecutor(copy_writers) as executor:
+                loading = [executor.submit(load_rows, rows) for rows in queues]
+
+                process_requests(queues)
+
+                counts = sum(load.result() for load in loading)
+
+            print('Inserts: {0}'.format(counts))
+        finally:
+            # Make the table crash-safe again and rebuild indexes in parallel, even
+            # after a failed load, so it is never left unlogged and without indexes.
+            # SET LOGGED rewrites the table and its indexes, so it goes first
+            execute_ddl(pg, sql_config['logActivityTable'])
+            create_indexes(sql_config['createActivityIndexes'])
+
+        # Post load activities, skipped after a failed load so the view keeps its old data
+        with futures.ThreadPoolExecutor(1) as executor:
+            # Analyze base table on a second connection while the view refreshes
+            analyzing = executor.submit(execute_ddl_connected, sql_config['analyzeActivityTable'])
+
+            # Refresh materialized view and analyze it
+            execute_ddl_batch(pg, [
+                sql_config['refreshActivity'],
+                sql_config['analyzeActivityView']
+            ])
+
+            analyzing.result()
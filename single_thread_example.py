@@ -1,4 +1,4 @@
-import json, psycopg2, requests, time
+import json, psycopg, requests, time
 
 with open('config.json', 'r') as configFile:
     config = json.load(configFile)
@@ -9,7 +9,7 @@ sql_config = config['SQL']
 
 def handler (event, context):
     # connect to database
-    pg = psycopg2.connect(host=db_config['host'], port=db_config['port'], database=db_config['database'], user=db_config['user'], password=db_config['password'])
+    pg = psycopg.connect(host=db_config['host'], port=db_config['port'], dbname=db_config['database'], user=db_config['user'], password=db_config['password'])
     # get characters
     pg_cursor = pg.cursor()
     pg_cursor.execute(sql_config['characterSelect'])
@@ -39,6 +39,8 @@ def handler (event, context):
             data = response.json()
             activities = data['Response']['activities']
 
+            inserts = []
+
             for activity in activities:
                 activity_hash = activity['activityHash']
                 stats = activity['values']
@@ -46,8 +48,7 @@ def handler (event, context):
                     stat_id = stats[stat]['statId']
                     stat = stats[stat]
 
-                    db_start_time = time.time()
-                    pg_cursor.execute(sql_config['statInsert'], (
+                    inserts.append((
                         character['group_id'],
                         character['clan_id'],
                         character['member_id'],
@@ -57,10 +58,16 @@ def handler (event, context):
                         json.dumps(stat)
                     ))
 
-                    pg.commit()
-                    db_end_time = time.time()
-                    db_duration += (db_end_time - db_start_time)
-                    insert_counter += 1
+            db_start_time = time.time()
+            pg_cursor.executemany(sql_config['statInsert'], inserts)
+            db_end_time = time.time()
+            db_duration += (db_end_time - db_start_time)
+            insert_counter += len(inserts)
+
+    db_start_time = time.time()
+    pg.commit()
+    db_end_time = time.time()
+    db_duration += (db_end_time - db_start_time)
 
     print('API Execution: {0:.2f}s'.format(api_duration))
     print('Database Inserts: {0}'.format(insert_counter))